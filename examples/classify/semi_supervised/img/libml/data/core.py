@@ -28,26 +28,44 @@ flags.DEFINE_integer('shuffle', 8192, 'Size of dataset shuffling.')
 FLAGS = flags.FLAGS
 
 
-def record_parse(index: int, record: str, image_shape: Tuple[int, int, int]):
+def shard_glob(filename: str) -> str:
+    """Glob matching the shards of a .tfrecord file written with create_datasets.py --num_shards."""
+    return filename[:-len('.tfrecord')] + '-?????-of-?????.tfrecord'
+
+
+def decode_record(record: str):
+    """Returns the uint8 image and label of a record, the image is either PNG encoded or raw pixels.
+
+    Raw records (create_datasets.py --raw) carry their height, width and channels, PNG records do not.
+    """
+    shape_feature = tf.io.FixedLenFeature([], tf.int64, default_value=0)
     features = tf.io.parse_single_example(record,
                                           features={'image': tf.io.FixedLenFeature([], tf.string),
-                                                    'label': tf.io.FixedLenFeature([], tf.int64)})
-    image = tf.image.decode_image(features['image'])
+                                                    'label': tf.io.FixedLenFeature([], tf.int64),
+                                                    'height': shape_feature,
+                                                    'width': shape_feature,
+                                                    'channels': shape_feature})
+    shape = tf.stack([features['height'], features['width'], features['channels']])
+    image = tf.cond(features['height'] > 0,
+                    lambda: tf.reshape(tf.io.decode_raw(features['image'], tf.uint8), shape),
+                    lambda: tf.image.decode_image(features['image']))
+    return image, features['label']
+
+
+def record_parse(index: int, record: str, image_shape: Tuple[int, int, int]):
+    image, label = decode_record(record)
     image.set_shape(image_shape)
     image = tf.cast(image, tf.float32) * (2.0 / 255) - 1.0
-    return dict(index=index, image=image, label=features['label'])
+    return dict(index=index, image=image, label=label)
 
 
 def record_parse_mnist(index: int, record: str, image_shape: Tuple[int, int, int]):
     del image_shape
-    features = tf.io.parse_single_example(record,
-                                          features={'image': tf.io.FixedLenFeature([], tf.string),
-                                                    'label': tf.io.FixedLenFeature([], tf.int64)})
-    image = tf.image.decode_image(features['image'])
+    image, label = decode_record(record)
     image = tf.pad(image, [(2, 2), (2, 2), (0, 0)])
     image.set_shape((32, 32, 3))
     image = tf.cast(image, tf.float32) * (2.0 / 255) - 1.0
-    return dict(index=index, image=image, label=features['label'])
+    return dict(index=index, image=image, label=label)
 
 
 class DataSet:
@@ -71,7 +89,9 @@ class DataSet:
                    image_shape: Tuple[int, int, int],
                    parse_fn: Optional[Callable] = record_parse):
         filenames_in = filenames
-        filenames = sorted(sum([tf.io.gfile.glob(x) for x in filenames], []))
+        filenames = sum([tf.io.gfile.glob(x) for x in filenames], [])
+        filenames += sum([tf.io.gfile.glob(shard_glob(x)) for x in filenames_in if x.endswith('.tfrecord')], [])
+        filenames = sorted(set(filenames))
         if not filenames:
             raise ValueError('Empty dataset, files not found:', filenames_in)
         return cls(tf.data.TFRecordDataset(filenames).enumerate(), image_shape, parse_fn=parse_fn)
@@ -142,11 +162,8 @@ def tiny_parse(index: int, record: str, image_shape: Tuple[int, int, int]):
 
 
 def record_parse_stl10_32(index: int, record: str, image_shape: Tuple[int, int, int]):
-    features = tf.io.parse_single_example(record,
-                                          features={'image': tf.io.FixedLenFeature([], tf.string),
-                                                    'label': tf.io.FixedLenFeature([], tf.int64)})
-    image = tf.image.decode_image(features['image'])
+    image, label = decode_record(record)
     image = tf.cast(image, tf.float32) * (2.0 / 255) - 1.0
     image = tf.nn.avg_pool2d([image], 3, 3, 'VALID')[0]
     image.set_shape(image_shape)
-    return dict(index=index, image=image, label=features['label'])
+    return dict(index=index, image=image, label=label)
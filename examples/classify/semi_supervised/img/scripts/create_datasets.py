@@ -18,22 +18,31 @@
 """
 
 import collections
+import contextlib
 import gzip
+import io
+import json
 import os
+import shutil
 import tarfile
 import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib import request
 
 import numpy as np
-import scipy.io
 import tensorflow as tf
-from absl import app
-from tqdm import trange
+from absl import app, flags
+from tqdm import tqdm, trange
 
 from examples.classify.semi_supervised.img.libml.data import core
 from objax.util import EasyDict
 from objax.util.image import to_png
 
+try:
+    import google_crc32c
+except ImportError:  # Without a native crc32c, records are framed by tf.io.TFRecordWriter instead.
+    google_crc32c = None
+
 URLS = {
     'svhn': 'http://ufldl.stanford.edu/housenumbers/{}_32x32.mat',
     'cifar10': 'https://www.cs.toronto.edu/~kriz/cifar-10-matlab.tar.gz',
@@ -42,20 +51,56 @@ URLS = {
     'mnist': 'http://yann.lecun.com/exdb/mnist/{}',
 }
 
+flags.DEFINE_bool('raw', False, 'Store raw uint8 pixels with their shape instead of PNG images, '
+                                'libml.data.core.decode_record reads both.')
+flags.DEFINE_integer('num_shards', 1, 'Number of .tfrecord files to split each dataset into. The training code '
+                     'finds the shards on its own, scripts taking explicit files need all of them.', lower_bound=1)
+flags.DEFINE_string('cache', '', 'Local directory where decoded images are kept, so that later runs can skip '
+                                 'downloading and decoding (empty to disable).')
+
+FLAGS = flags.FLAGS
+
+
+# Number of records a worker encodes per task when building a TFRecord file.
+RECORD_CHUNK_SIZE = 256
+# Below this many images, process startup costs more than it saves, use threads instead.
+PNG_MIN_PROCESS_BATCH = 64
+# Bytes of framed records buffered before each write to the output file.
+RECORD_WRITE_BUFFER = 1 << 20
+
+
+def _iter_tar_members(f, names):
+    """Yields (name, contents) of the named members of a .tar.gz file object in a single pass, no seeking needed."""
+    with tarfile.open(fileobj=f, mode='r|gz') as tar:
+        for member in tar:
+            if member.name in names:
+                yield member.name, tar.extractfile(member).read()
 
-def _encode_png(images):
-    return [to_png(images[x]) for x in trange(images.shape[0], desc='PNG Encoding', leave=False)]
+
+def _loadmat(file):
+    """Loads a .mat file from a file name or a seekable file object."""
+    import scipy.io  # Only the .mat loaders need scipy, avoid its import cost for the others.
+    return scipy.io.loadmat(file)
+
+
+def _stream_tar_mats(url, names):
+    """Loads the named .mat members of a remote .tar.gz while it downloads, in a single pass."""
+    with request.urlopen(url) as f:
+        # loadmat needs a seekable file, the tar stream is not.
+        return {name: _loadmat(io.BytesIO(data)) for name, data in _iter_tar_members(f, names)}
 
 
 def _load_svhn():
     splits = collections.OrderedDict()
     for split in ['train', 'test', 'extra']:
+        # loadmat cannot stream, reading from disk avoids holding the whole file in memory next to its arrays.
         with tempfile.NamedTemporaryFile() as f:
-            request.urlretrieve(URLS['svhn'].format(split), f.name)
-            data_dict = scipy.io.loadmat(f.name)
+            with request.urlopen(URLS['svhn'].format(split)) as response:
+                shutil.copyfileobj(response, f)
+            f.flush()
+            data_dict = _loadmat(f.name)
         dataset = {}
         dataset['images'] = np.transpose(data_dict['X'], [3, 0, 1, 2])
-        dataset['images'] = _encode_png(dataset['images'])
         dataset['labels'] = data_dict['y'].reshape((-1))
         # SVHN raw data uses labels from 1 to 10; use 0 to 9 instead.
         dataset['labels'] %= 10  # Label number 10 is for 0.
@@ -65,131 +110,120 @@ def _load_svhn():
 
 def _load_stl10():
     def unflatten(images):
-        return np.transpose(images.reshape((-1, 3, 96, 96)), [0, 3, 2, 1])
+        # Materialize the H/W swap in one large copy rather than one strided copy per image later.
+        return np.ascontiguousarray(images.reshape((-1, 3, 96, 96)).transpose([0, 3, 2, 1]))
 
-    with tempfile.NamedTemporaryFile() as f:
-        if tf.io.gfile.exists('stl10/stl10_binary.tar.gz'):
-            f = tf.io.gfile.GFile('stl10/stl10_binary.tar.gz', 'rb')
-        else:
-            request.urlretrieve(URLS['stl10'], f.name)
-        tar = tarfile.open(fileobj=f)
-        train_x = tar.extractfile('stl10_binary/train_X.bin')
-        train_y = tar.extractfile('stl10_binary/train_y.bin')
-        test_x = tar.extractfile('stl10_binary/test_X.bin')
-        test_y = tar.extractfile('stl10_binary/test_y.bin')
-        unlabeled_x = tar.extractfile('stl10_binary/unlabeled_X.bin')
-        train_set = {'images': np.frombuffer(train_x.read(), dtype=np.uint8),
-                     'labels': np.frombuffer(train_y.read(), dtype=np.uint8) - 1}
-        test_set = {'images': np.frombuffer(test_x.read(), dtype=np.uint8),
-                    'labels': np.frombuffer(test_y.read(), dtype=np.uint8) - 1}
-        _imgs = np.frombuffer(unlabeled_x.read(), dtype=np.uint8)
-        unlabeled_set = {'images': _imgs,
-                         'labels': np.zeros(100000, dtype=np.uint8)}
-        fold_indices = tar.extractfile('stl10_binary/fold_indices.txt').read()
-
-    train_set['images'] = _encode_png(unflatten(train_set['images']))
-    test_set['images'] = _encode_png(unflatten(test_set['images']))
-    unlabeled_set['images'] = _encode_png(unflatten(unlabeled_set['images']))
+    def read_labels(data):
+        # STL10 raw data uses labels from 1 to 10; use 0 to 9 instead. frombuffer is read-only, so copy once.
+        labels = np.frombuffer(data, dtype=np.uint8).copy()
+        labels -= 1
+        return labels
+
+    if tf.io.gfile.exists('stl10/stl10_binary.tar.gz'):
+        f = tf.io.gfile.GFile('stl10/stl10_binary.tar.gz', 'rb')
+    else:
+        f = request.urlopen(URLS['stl10'])
+    names = ['train_X.bin', 'train_y.bin', 'test_X.bin', 'test_y.bin', 'unlabeled_X.bin', 'fold_indices.txt']
+    with f:
+        files = {os.path.basename(name): data
+                 for name, data in _iter_tar_members(f, frozenset('stl10_binary/' + x for x in names))}
+    train_set = {'images': np.frombuffer(files['train_X.bin'], dtype=np.uint8),
+                 'labels': read_labels(files['train_y.bin'])}
+    test_set = {'images': np.frombuffer(files['test_X.bin'], dtype=np.uint8),
+                'labels': read_labels(files['test_y.bin'])}
+    unlabeled_set = {'images': np.frombuffer(files['unlabeled_X.bin'], dtype=np.uint8),
+                     'labels': np.zeros(100000, dtype=np.uint8)}
+    fold_indices = files['fold_indices.txt']
+
+    train_set['images'] = unflatten(train_set['images'])
+    test_set['images'] = unflatten(test_set['images'])
+    unlabeled_set['images'] = unflatten(unlabeled_set['images'])
     return dict(train=train_set, test=test_set, unlabeled=unlabeled_set,
                 files=[EasyDict(filename="stl10_fold_indices.txt", data=fold_indices)])
 
 
 def _load_cifar10():
     def unflatten(images):
-        return np.transpose(images.reshape((images.shape[0], 3, 32, 32)),
-                            [0, 2, 3, 1])
-
-    with tempfile.NamedTemporaryFile() as f:
-        request.urlretrieve(URLS['cifar10'], f.name)
-        tar = tarfile.open(fileobj=f)
-        train_data_batches, train_data_labels = [], []
-        for batch in range(1, 6):
-            data_dict = scipy.io.loadmat(tar.extractfile('cifar-10-batches-mat/data_batch_{}.mat'.format(batch)))
-            train_data_batches.append(data_dict['data'])
-            train_data_labels.append(data_dict['labels'].flatten())
-        train_set = {'images': np.concatenate(train_data_batches, axis=0),
-                     'labels': np.concatenate(train_data_labels, axis=0)}
-        data_dict = scipy.io.loadmat(tar.extractfile('cifar-10-batches-mat/test_batch.mat'))
-        test_set = {'images': data_dict['data'],
-                    'labels': data_dict['labels'].flatten()}
-    train_set['images'] = _encode_png(unflatten(train_set['images']))
-    test_set['images'] = _encode_png(unflatten(test_set['images']))
+        # One contiguous copy up front so each image handed to the PNG encoder is row-major.
+        return np.ascontiguousarray(np.transpose(images.reshape((-1, 3, 32, 32)), [0, 2, 3, 1]))
+
+    train_names = ['cifar-10-batches-mat/data_batch_{}.mat'.format(batch) for batch in range(1, 6)]
+    test_name = 'cifar-10-batches-mat/test_batch.mat'
+    mats = _stream_tar_mats(URLS['cifar10'], frozenset(train_names + [test_name]))
+    train_set = {'images': np.concatenate([mats[name]['data'] for name in train_names], axis=0),
+                 'labels': np.concatenate([mats[name]['labels'].flatten() for name in train_names], axis=0)}
+    test_set = {'images': mats[test_name]['data'],
+                'labels': mats[test_name]['labels'].flatten()}
+    train_set['images'] = unflatten(train_set['images'])
+    test_set['images'] = unflatten(test_set['images'])
     return dict(train=train_set, test=test_set)
 
 
 def _load_cifar100():
     def unflatten(images):
-        return np.transpose(images.reshape((images.shape[0], 3, 32, 32)), [0, 2, 3, 1])
-
-    with tempfile.NamedTemporaryFile() as f:
-        request.urlretrieve(URLS['cifar100'], f.name)
-        tar = tarfile.open(fileobj=f)
-        data_dict = scipy.io.loadmat(tar.extractfile('cifar-100-matlab/train.mat'))
-        train_set = {'images': data_dict['data'],
-                     'labels': data_dict['fine_labels'].flatten()}
-        data_dict = scipy.io.loadmat(tar.extractfile('cifar-100-matlab/test.mat'))
-        test_set = {'images': data_dict['data'],
-                    'labels': data_dict['fine_labels'].flatten()}
-    train_set['images'] = _encode_png(unflatten(train_set['images']))
-    test_set['images'] = _encode_png(unflatten(test_set['images']))
+        # One contiguous copy up front so each image handed to the PNG encoder is row-major.
+        return np.ascontiguousarray(np.transpose(images.reshape((-1, 3, 32, 32)), [0, 2, 3, 1]))
+
+    mats = _stream_tar_mats(URLS['cifar100'], frozenset(['cifar-100-matlab/train.mat', 'cifar-100-matlab/test.mat']))
+    train_set = {'images': mats['cifar-100-matlab/train.mat']['data'],
+                 'labels': mats['cifar-100-matlab/train.mat']['fine_labels'].flatten()}
+    test_set = {'images': mats['cifar-100-matlab/test.mat']['data'],
+                'labels': mats['cifar-100-matlab/test.mat']['fine_labels'].flatten()}
+    train_set['images'] = unflatten(train_set['images'])
+    test_set['images'] = unflatten(test_set['images'])
     return dict(train=train_set, test=test_set)
 
 
-def _load_mnist():
-    image_filename = '{}-images-idx3-ubyte.gz'
-    label_filename = '{}-labels-idx1-ubyte.gz'
+def _download_all(urls):
+    """Downloads all urls concurrently and returns their contents in the same order."""
+
+    def fetch(url):
+        print(url)
+        with request.urlopen(url) as f:
+            return f.read()
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        return list(executor.map(fetch, urls))
+
+
+def _read_idx_images(buffer):
+    with gzip.GzipFile(fileobj=io.BytesIO(buffer), mode='r') as data:
+        assert _read32(data) == 2051
+        n_images = _read32(data)
+        row = _read32(data)
+        col = _read32(data)
+        images = np.frombuffer(data.read(n_images * row * col), dtype=np.uint8)
+        return images.reshape((n_images, row, col, 1))
+
+
+def _read_idx_labels(buffer):
+    with gzip.GzipFile(fileobj=io.BytesIO(buffer), mode='r') as data:
+        assert _read32(data) == 2049
+        n_labels = _read32(data)
+        return np.frombuffer(data.read(n_labels), dtype=np.uint8)
+
+
+def _load_idx(url, image_filename, label_filename):
     split_files = [('train', 'train'), ('test', 't10k')]
+    urls = [url.format(filename.format(split_file)) for _, split_file in split_files
+            for filename in (image_filename, label_filename)]
+    buffers = _download_all(urls)
     splits = {}
-    for split, split_file in split_files:
-        with tempfile.NamedTemporaryFile() as f:
-            url = URLS['mnist'].format(image_filename.format(split_file))
-            print(url)
-            request.urlretrieve(url, f.name)
-            with gzip.GzipFile(fileobj=f, mode='r') as data:
-                assert _read32(data) == 2051
-                n_images = _read32(data)
-                row = _read32(data)
-                col = _read32(data)
-                images = np.frombuffer(data.read(n_images * row * col), dtype=np.uint8)
-                images = images.reshape((n_images, row, col, 1))
-        with tempfile.NamedTemporaryFile() as f:
-            request.urlretrieve(URLS['mnist'].format(label_filename.format(split_file)), f.name)
-            with gzip.GzipFile(fileobj=f, mode='r') as data:
-                assert _read32(data) == 2049
-                n_labels = _read32(data)
-                labels = np.frombuffer(data.read(n_labels), dtype=np.uint8)
-        splits[split] = {'images': _encode_png(images), 'labels': labels}
+    for i, (split, _) in enumerate(split_files):
+        splits[split] = {'images': _read_idx_images(buffers[2 * i]), 'labels': _read_idx_labels(buffers[2 * i + 1])}
     return splits
 
 
+def _load_mnist():
+    return _load_idx(URLS['mnist'], '{}-images-idx3-ubyte.gz', '{}-labels-idx1-ubyte.gz')
+
+
 def _load_fashionmnist():
-    image_filename = '{}-images-idx3-ubyte'
-    label_filename = '{}-labels-idx1-ubyte'
-    split_files = [('train', 'train'), ('test', 't10k')]
-    splits = {}
-    for split, split_file in split_files:
-        with tempfile.NamedTemporaryFile() as f:
-            request.urlretrieve(URLS['fashion_mnist'].format(image_filename.format(split_file)), f.name)
-            with gzip.GzipFile(fileobj=f, mode='r') as data:
-                assert _read32(data) == 2051
-                n_images = _read32(data)
-                row = _read32(data)
-                col = _read32(data)
-                images = np.frombuffer(data.read(n_images * row * col), dtype=np.uint8)
-                images = images.reshape((n_images, row, col, 1))
-        with tempfile.NamedTemporaryFile() as f:
-            request.urlretrieve(URLS['fashion_mnist'].format(label_filename.format(split_file)), f.name)
-            with gzip.GzipFile(fileobj=f, mode='r') as data:
-                assert _read32(data) == 2049
-                n_labels = _read32(data)
-                labels = np.frombuffer(data.read(n_labels), dtype=np.uint8)
-        splits[split] = {'images': _encode_png(images), 'labels': labels}
-    return splits
+    return _load_idx(URLS['fashion_mnist'], '{}-images-idx3-ubyte', '{}-labels-idx1-ubyte')
 
 
 def _read32(data):
-    dt = np.dtype(np.uint32).newbyteorder('>')
-    return np.frombuffer(data.read(4), dtype=dt)[0]
+    return int.from_bytes(data.read(4), 'big')
 
 
 def _int64_feature(value):
@@ -200,23 +234,215 @@ def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
 
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number, payload):
+    """Protobuf wire format of a length-delimited field."""
+    return bytes([number << 3 | 2]) + _varint(len(payload)) + payload
+
+
+# Features.feature is a map, each entry is a message with the key as field 1 and the Feature as field 2.
+def _label_entry(label):
+    label &= (1 << 64) - 1  # int64 varints encode negative values as 64-bit two's complement.
+    return _field(1, _field(1, b'label') + _field(2, _field(3, _field(1, _varint(label)))))  # Feature.int64_list
+
+
+# Serialized label entries for every label value used by these datasets.
+_LABEL_ENTRIES = tuple(_label_entry(label) for label in range(1000))
+
+
+def _serialize_example(image, label):
+    """Deterministic serialization of tf.train.Example(image=BytesList([image]), label=Int64List([label]))."""
+    label = int(label)
+    label_entry = _LABEL_ENTRIES[label] if 0 <= label < len(_LABEL_ENTRIES) else _label_entry(label)
+    image_entry = _field(1, _field(1, b'image') + _field(2, _field(1, _field(1, image))))  # Feature.bytes_list
+    return _field(1, image_entry + label_entry)
+
+
+def _masked_crc32c(data):
+    crc = google_crc32c.value(data)
+    return ((((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff).to_bytes(4, 'little')
+
+
+class _TFRecordFile:
+    """Uncompressed TFRecord writer that frames records in Python and writes them out in large blocks."""
+
+    def __init__(self, filename):
+        self.file = tf.io.gfile.GFile(filename, 'wb')
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, record):
+        length = len(record).to_bytes(8, 'little')
+        self.buffer += [length, _masked_crc32c(length), record, _masked_crc32c(record)]
+        self.buffer_size += len(record) + 16
+        if self.buffer_size >= RECORD_WRITE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        self.file.write(b''.join(self.buffer))
+        self.buffer.clear()
+        self.buffer_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+        self.file.close()
+
+
+def _record_writer(filename):
+    # google_crc32c silently falls back to a pure Python CRC that is far slower than TFRecordWriter.
+    if google_crc32c is None or google_crc32c.implementation != 'c':
+        return tf.io.TFRecordWriter(filename)
+    return _TFRecordFile(filename)
+
+
+def _shard_filenames(filename, num_shards):
+    if num_shards == 1:
+        return [filename + '.tfrecord']
+    return ['%s-%05d-of-%05d.tfrecord' % (filename, shard, num_shards) for shard in range(num_shards)]
+
+
+def _output_filenames(filename):
+    """Record files to write for filename, deleting any left from a different --num_shards."""
+    filename = os.path.join(core.DATA_DIR, filename)
+    filenames = _shard_filenames(filename, FLAGS.num_shards)
+    for x in tf.io.gfile.glob(filename + '.tfrecord') + tf.io.gfile.glob(core.shard_glob(filename + '.tfrecord')):
+        if x not in filenames:
+            tf.io.gfile.remove(x)
+    return filenames
+
+
+@contextlib.contextmanager
+def _committed_on_success(filenames):
+    """Yields temporary names for filenames, renamed into place only if the block completes.
+
+    A failed or interrupted write leaves nothing under the final names, so it is never taken as installed.
+    """
+    temp_filenames = [filename + '.tmp' for filename in filenames]
+    try:
+        yield temp_filenames
+    except BaseException:
+        for temp_filename in temp_filenames:
+            if tf.io.gfile.exists(temp_filename):
+                tf.io.gfile.remove(temp_filename)
+        raise
+    for temp_filename, filename in zip(temp_filenames, filenames):
+        tf.io.gfile.rename(temp_filename, filename, overwrite=True)
+
+
+class _ShardedRecordWriter:
+    """Writes count records in order, split into contiguous ranges of near equal size, one per file."""
+
+    def __init__(self, filenames, count):
+        self.files = contextlib.ExitStack()
+        self.writers = [self.files.enter_context(_record_writer(filename)) for filename in filenames]
+        self.ends = [count * (shard + 1) // len(filenames) for shard in range(len(filenames))]
+        self.shard = 0
+        self.written = 0
+
+    def write(self, record):
+        while self.written >= self.ends[self.shard]:
+            self.shard += 1
+        self.writers[self.shard].write(record)
+        self.written += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return self.files.__exit__(*args)
+
+
+def _encode_records(images, labels):
+    return [_serialize_example(to_png(image), label) for image, label in zip(images, labels)]
+
+
+def _stream_encode_and_write(images, labels, filenames, n_workers):
+    """PNG-encodes records in worker processes while the main process writes them, in input order.
+
+    At most 2 * n_workers chunks are in flight, so memory does not grow with the dataset size.
+    """
+    pool = ThreadPoolExecutor if len(images) < PNG_MIN_PROCESS_BATCH else ProcessPoolExecutor
+    pending = collections.deque()
+
+    def write_oldest():
+        records = pending.popleft().result()
+        for record in records:
+            writer.write(record)
+        progress.update(len(records))
+
+    with pool(max_workers=n_workers) as executor, \
+            _ShardedRecordWriter(filenames, len(images)) as writer, \
+            tqdm(total=len(images), desc='Building records', leave=False) as progress:
+        for start in range(0, len(images), RECORD_CHUNK_SIZE):
+            if len(pending) >= 2 * n_workers:
+                write_oldest()
+            end = start + RECORD_CHUNK_SIZE
+            pending.append(executor.submit(_encode_records, images[start:end], labels[start:end]))
+        while pending:
+            write_oldest()
+
+
 def _save_as_tfrecord(data, filename):
     assert len(data['images']) == len(data['labels'])
-    filename = os.path.join(core.DATA_DIR, filename + '.tfrecord')
-    print('Saving dataset:', filename)
-    with tf.io.TFRecordWriter(filename) as writer:
-        for x in trange(len(data['images']), desc='Building records'):
-            feat = dict(image=_bytes_feature(data['images'][x]),
-                        label=_int64_feature(data['labels'][x]))
-            record = tf.train.Example(features=tf.train.Features(feature=feat))
+    filenames = _output_filenames(filename)
+    print('Saving dataset:', ', '.join(filenames))
+    with _committed_on_success(filenames) as temp_filenames:
+        _stream_encode_and_write(data['images'], data['labels'], temp_filenames, n_workers=os.cpu_count() or 1)
+    print('Saved:', ', '.join(filenames))
+
+
+def _save_as_raw_tfrecord(data, filename):
+    assert len(data['images']) == len(data['labels'])
+    images = data['images']
+    if images.shape[3] == 1:  # Like to_png, store grayscale as RGB so both formats decode to the same shape.
+        images = np.broadcast_to(images, images.shape[:3] + (3,))
+    height, width, channels = images.shape[1:]
+    filenames = _output_filenames(filename)
+    print('Saving dataset:', ', '.join(filenames))
+    # Build the record once and only swap the per-image values in the loop.
+    feat = dict(image=_bytes_feature(b''),
+                height=_int64_feature(height),
+                width=_int64_feature(width),
+                channels=_int64_feature(channels),
+                label=_int64_feature(0))
+    record = tf.train.Example(features=tf.train.Features(feature=feat))
+    image = record.features.feature['image'].bytes_list.value
+    label = record.features.feature['label'].int64_list.value
+    with _committed_on_success(filenames) as temp_filenames, \
+            _ShardedRecordWriter(temp_filenames, len(images)) as writer:
+        for x in trange(len(images), desc='Building records'):
+            image[:] = [np.ascontiguousarray(images[x]).tobytes()]
+            label[:] = [int(data['labels'][x])]
             writer.write(record.SerializeToString())
-    print('Saved:', filename)
+    print('Saved:', ', '.join(filenames))
+
+
+def _is_raw_tfrecord(filename):
+    """Whether a record file was written by _save_as_raw_tfrecord, None if it holds no record."""
+    record = next(iter(tf.compat.v1.python_io.tf_record_iterator(filename)), None)
+    if record is None:
+        return None
+    return 'height' in tf.train.Example.FromString(record).features.feature
 
 
 def _is_installed(name, checksums):
     for subset, checksum in checksums.items():
-        filename = os.path.join(core.DATA_DIR, '%s-%s.tfrecord' % (name, subset))
-        if not tf.io.gfile.exists(filename):
+        filenames = _shard_filenames(os.path.join(core.DATA_DIR, '%s-%s' % (name, subset)), FLAGS.num_shards)
+        if not all(tf.io.gfile.exists(x) for x in filenames):
+            return False
+        if _is_raw_tfrecord(filenames[0]) not in (None, FLAGS.raw):
+            print('Replacing %s records written in the other format:' % name, filenames[0])
             return False
     return True
 
@@ -234,6 +460,60 @@ def _is_installed_folder(name, folder):
     return tf.io.gfile.exists(os.path.join(core.DATA_DIR, name, folder))
 
 
+def _replace_file(filename, write):
+    """Writes a file through write(f) and renames it into place, so that it is either complete or absent."""
+    with open(filename + '.tmp', 'wb') as f:
+        write(f)
+    os.replace(filename + '.tmp', filename)
+
+
+def _save_cache(name, datas):
+    os.makedirs(FLAGS.cache, exist_ok=True)
+    manifest = dict(subsets=[], files=[], readme=datas.get('readme'))
+    for sub_name, data in datas.items():
+        if sub_name == 'readme':
+            continue
+        if sub_name == 'files':
+            for file_and_data in data:
+                filename = os.path.join(FLAGS.cache, '%s-file-%s' % (name, file_and_data.filename))
+                _replace_file(filename, lambda f: f.write(file_and_data.data))
+                manifest['files'].append(file_and_data.filename)
+            continue
+        for key in ('labels', 'images'):
+            filename = os.path.join(FLAGS.cache, '%s-%s-%s.npy' % (name, sub_name, key))
+            _replace_file(filename, lambda f: np.save(f, data[key]))
+        manifest['subsets'].append(sub_name)
+    # The manifest is written last, its presence marks a complete cache.
+    _replace_file(os.path.join(FLAGS.cache, name + '-manifest.json'),
+                  lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+
+def _load_cache(name, checksums):
+    """Returns the cached loader output of a dataset, or {} unless every expected subset is present."""
+    filename = os.path.join(FLAGS.cache, name + '-manifest.json')
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+    paths = {sub_name: os.path.join(FLAGS.cache, '%s-%s-' % (name, sub_name)) for sub_name in manifest['subsets']}
+    files = {x: os.path.join(FLAGS.cache, '%s-file-%s' % (name, x)) for x in manifest['files']}
+    expected = [path + key for path in paths.values() for key in ('labels.npy', 'images.npy')] + list(files.values())
+    if not set(checksums).issubset(paths) or not all(os.path.exists(path) for path in expected):
+        return {}
+    datas = collections.OrderedDict()
+    for sub_name, path in paths.items():
+        datas[sub_name] = dict(images=np.load(path + 'images.npy', mmap_mode='r'),
+                               labels=np.load(path + 'labels.npy', mmap_mode='r'))
+    if manifest['readme'] is not None:
+        datas['readme'] = manifest['readme']
+    if files:
+        datas['files'] = []
+        for filename, path in files.items():
+            with open(path, 'rb') as f:
+                datas['files'].append(EasyDict(filename=filename, data=f.read()))
+    return datas
+
+
 CONFIGS = {
     'cifar10': dict(loader=_load_cifar10, checksums=dict(train=None, test=None)),
     'cifar100': dict(loader=_load_cifar100, checksums=dict(train=None, test=None)),
@@ -260,8 +540,14 @@ def main(argv):
             print('Skipping already installed:', name)
             continue
         print('Preparing', name)
-        datas = config['loader']()
-        saver = config.get('saver', _save_as_tfrecord)
+        datas = _load_cache(name, config['checksums']) if FLAGS.cache else {}
+        if datas:
+            print('Using cached images from', FLAGS.cache)
+        else:
+            datas = config['loader']()
+            if FLAGS.cache:
+                _save_cache(name, datas)
+        saver = config.get('saver', _save_as_raw_tfrecord if FLAGS.raw else _save_as_tfrecord)
         for sub_name, data in datas.items():
             if sub_name == 'readme':
                 filename = os.path.join(core.DATA_DIR, '%s-%s.txt' % (name, sub_name))
@@ -0,0 +1,60 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittests for the hand-written record encoding of the semi-supervised create_datasets.py script."""
+
+import importlib.util
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+HAS_TF = importlib.util.find_spec('tensorflow') is not None
+if HAS_TF:
+    import tensorflow as tf
+
+    os.environ.setdefault('ML_DATA', tempfile.gettempdir())
+    os.environ.setdefault('PROJECT', 'objax_tests')
+    from examples.classify.semi_supervised.img.scripts import create_datasets
+
+
+@unittest.skipUnless(HAS_TF, 'The example scripts require tensorflow.')
+class TestCreateDatasets(unittest.TestCase):
+    def test_serialize_example(self):
+        """Hand-encoded Examples are byte for byte the deterministic protobuf serialization."""
+        for image, label in [(b'', 0), (b'x' * 5, 9), (bytes(range(256)) * 40, 99), (b'y' * 200, 999),
+                             (b'z', np.uint8(7)), (b'w' * 3, 1234567), (b'v', -1), (b'u', -(1 << 63))]:
+            feat = dict(image=create_datasets._bytes_feature(image), label=create_datasets._int64_feature(label))
+            expected = tf.train.Example(features=tf.train.Features(feature=feat)).SerializeToString(deterministic=True)
+            self.assertEqual(create_datasets._serialize_example(image, label), expected)
+
+    @unittest.skipUnless(HAS_TF and create_datasets.google_crc32c is not None, 'Requires google_crc32c.')
+    def test_tfrecord_file(self):
+        """_TFRecordFile writes the same bytes as tf.io.TFRecordWriter, across several write buffers."""
+        records = [create_datasets._serialize_example(b'q' * n, n % 10) for n in range(0, 100000, 997)]
+        contents = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for writer_class in (create_datasets._TFRecordFile, tf.io.TFRecordWriter):
+                filename = os.path.join(tmpdir, writer_class.__name__ + '.tfrecord')
+                with writer_class(filename) as writer:
+                    for record in records:
+                        writer.write(record)
+                with open(filename, 'rb') as f:
+                    contents.append(f.read())
+        self.assertEqual(contents[0], contents[1])
+
+
+if __name__ == '__main__':
+    unittest.main()